@@ -7,25 +7,34 @@ Trending products → affiliate URLs → Excel → Email (JST)
   .txt と .html の2種類で添付（iPhoneでコピーしやすい）
 - 楽天APIは429/400対策、キーワード整形、ペース調整済み
 """
-import os, re, json, time, logging, pathlib, datetime as dt, smtplib
+import os, re, io, json, atexit, mmap, base64, functools, time, random, shelve, asyncio, logging, logging.handlers, pathlib, datetime as dt, smtplib
 from typing import List, Union, Optional
-from urllib.parse import urlencode, quote_plus
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote_plus
 
 import pandas as pd
+import openpyxl
 from pytrends.request import TrendReq
-import requests, pytz
+import requests, aiohttp
+from requests.adapters import HTTPAdapter
+from zoneinfo import ZoneInfo
 from email.message import EmailMessage
-from email.utils import formatdate, make_msgid
+from email.utils import formatdate, make_msgid, parsedate_to_datetime
 import html as htmlmod
 
 APP_DIR = pathlib.Path(__file__).resolve().parent
 OUTPUT_XLSX = APP_DIR / "trending_affiliates.xlsx"
 LOG_FILE = APP_DIR / "run.log"
+RAKUTEN_CACHE_DB = APP_DIR / "rakuten_cache"
+EXCEL_COLUMNS = ["timestamp", "date", "keyword", "rakuten_url", "amazon_url"]
 
 RAKUTEN_APP_ID = os.getenv("RAKUTEN_APPLICATION_ID", "")
 RAKUTEN_AFFILIATE_ID = os.getenv("RAKUTEN_AFFILIATE_ID", "")
 AMAZON_ASSOCIATE_TAG = os.getenv("AMAZON_ASSOCIATE_TAG", "")
 NO_FILTER = os.getenv("NO_FILTER", "0") == "1"
+RAKUTEN_CONCURRENCY = 4
+# 全リクエスト共通の開始間隔（楽天APIは1アプリIDあたり約1リクエスト/秒）
+RAKUTEN_MIN_INTERVAL_SEC = float(os.getenv("RAKUTEN_MIN_INTERVAL_SEC", "1.0"))
 
 EMAIL_CFG = {}
 CONFIG_JSON = APP_DIR / "config.json"
@@ -39,57 +48,86 @@ if CONFIG_JSON.exists():
     except Exception:
         pass
 
+LOG_FORMAT = "%(asctime)s [%(levelname)s] %(message)s"
+# File writes are buffered and flushed on ERROR or at exit
+_log_file = logging.FileHandler(LOG_FILE, encoding="utf-8")
+_log_file.setFormatter(logging.Formatter(LOG_FORMAT))
+_LOG_BUFFER = logging.handlers.MemoryHandler(1024, flushLevel=logging.ERROR, target=_log_file)
 logging.basicConfig(
     level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
+    format=LOG_FORMAT,
     handlers=[
-        logging.FileHandler(LOG_FILE, encoding="utf-8"),
+        _LOG_BUFFER,
         logging.StreamHandler()
     ]
 )
+atexit.register(_LOG_BUFFER.flush)
 logger = logging.getLogger("affi_mail")
-JST = pytz.timezone("Asia/Tokyo")
+JST = ZoneInfo("Asia/Tokyo")
 
 def jst_now():
     return dt.datetime.now(JST)
 
-def get_top_trends_japan(n=20):
-    pytrends = TrendReq(hl='ja-JP', tz=540)
-    try:
-        df = pytrends.trending_searches(pn='japan')
-        if df is not None and not df.empty:
-            return df[0].astype(str).head(n).tolist()
-    except Exception as e:
-        logger.warning(f"trending_searches failed: {e}")
-    try:
-        df = pytrends.today_searches(pn='JP')
-        if df is not None and not df.empty:
-            try:
-                return df.astype(str).head(n).tolist()
-            except Exception:
-                if 0 in df.columns:
-                    return df[0].astype(str).head(n).tolist()
-                if 'query' in df.columns:
-                    return df['query'].astype(str).head(n).tolist()
-    except Exception as e:
-        logger.warning(f"today_searches failed: {e}")
-    try:
-        df = pytrends.realtime_trending_searches(pn='JP')
-        if df is not None and not df.empty:
-            if 'title' in df.columns:
-                out = []
-                for v in df['title'].tolist():
-                    if isinstance(v, dict) and 'query' in v:
-                        out.append(v['query'])
-                    else:
-                        out.append(str(v))
-                return out[:n]
+@functools.lru_cache(maxsize=1)
+def _trendreq() -> TrendReq:
+    """Shared TrendReq so the Google cookie handshake happens once per process."""
+    return TrendReq(hl='ja-JP', tz=540)
+
+def _trending_searches(pytrends, n):
+    df = pytrends.trending_searches(pn='japan')
+    if df is not None and not df.empty:
+        return df[0].astype(str).head(n).tolist()
+    return []
+
+def _today_searches(pytrends, n):
+    df = pytrends.today_searches(pn='JP')
+    if df is not None and not df.empty:
+        try:
+            return df.astype(str).head(n).tolist()
+        except Exception:
+            if 0 in df.columns:
+                return df[0].astype(str).head(n).tolist()
             if 'query' in df.columns:
                 return df['query'].astype(str).head(n).tolist()
-    except Exception as e:
-        logger.error(f"realtime_trending_searches failed: {e}")
     return []
 
+def _realtime_trending_searches(pytrends, n):
+    df = pytrends.realtime_trending_searches(pn='JP')
+    if df is not None and not df.empty:
+        if 'title' in df.columns:
+            out = []
+            for v in df['title'].tolist():
+                if isinstance(v, dict) and 'query' in v:
+                    out.append(v['query'])
+                else:
+                    out.append(str(v))
+            return out[:n]
+        if 'query' in df.columns:
+            return df['query'].astype(str).head(n).tolist()
+    return []
+
+# (name, fetch, log level on failure) — the last source failing means Google gave us nothing
+_TREND_SOURCES = (
+    ("trending_searches", _trending_searches, logging.WARNING),
+    ("today_searches", _today_searches, logging.WARNING),
+    ("realtime_trending_searches", _realtime_trending_searches, logging.ERROR),
+)
+
+def get_top_trends_japan(n=20):
+    pytrends = _trendreq()
+    for name, fn, level in _TREND_SOURCES:
+        try:
+            out = fn(pytrends, n)
+            if out:
+                return out
+        except Exception as e:
+            logger.log(level, f"{name} failed: {e}")
+    return []
+
+# Keep-alive pool for synchronous Rakuten calls (searches share an aiohttp session)
+_RAKUTEN_SESSION = requests.Session()
+_RAKUTEN_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=0))
+
 def fallback_keywords_from_rakuten_ranking(limit=20):
     if not RAKUTEN_APP_ID:
         logger.warning("Rakuten AppID missing; cannot fallback to Rakuten ranking.")
@@ -97,7 +135,7 @@ def fallback_keywords_from_rakuten_ranking(limit=20):
     endpoint = "https://app.rakuten.co.jp/services/api/IchibaItem/Ranking/20170628"
     params = {"applicationId": RAKUTEN_APP_ID, "format": "json", "genreId": 0, "page": 1}
     try:
-        r = requests.get(endpoint, params=params, timeout=10)
+        r = _RAKUTEN_SESSION.get(endpoint, params=params, timeout=10)
         r.raise_for_status()
         data = r.json()
         items = data.get("Items", [])
@@ -113,83 +151,259 @@ def fallback_keywords_from_rakuten_ranking(limit=20):
         logger.error(f"Rakuten ranking fallback failed: {e}")
         return []
 
+_RAKUTEN_MEMO = {}  # "YYYY-MM-DD|keyword" -> affiliate URL
+_NEG_CACHE = set()  # "YYYY-MM-DD|keyword" keys that returned no items
+
 _MODEL_TOKEN = re.compile(r"[A-Za-z]*\d{2,}[A-Za-z0-9\-]*")
 _KATAKANA = re.compile(r"[\u30A0-\u30FF]")
+_RE_ASCII = re.compile(r"[A-Za-z]")
+_RE_WS = re.compile(r"[\u3000\s]+")
+_RE_NONWORD = re.compile(r"[^\w\u3040-\u309F\u30A0-\u30FF\u4E00-\u9FFF\-\+A-Za-z0-9 ]")
+_RE_MULTISPACE = re.compile(r"\s{2,}")
+PRODUCT_HINTS = ("レビュー", "比較", "おすすめ", "型番", "最安値")
+_RE_HINTS = re.compile("|".join(map(re.escape, PRODUCT_HINTS)))
 def is_productish(term: str) -> bool:
     t = term.strip()
     if len(t) <= 1: return False
     if _MODEL_TOKEN.search(t): return True
     if _KATAKANA.search(t): return True
-    for hint in ["レビュー", "比較", "おすすめ", "型番", "最安値"]:
+    for hint in PRODUCT_HINTS:
         if hint in t: return True
-    if re.search(r"[A-Za-z]", t) and len(t) <= 20: return True
+    if _RE_ASCII.search(t) and len(t) <= 20: return True
     return False
 
+def filter_productish(terms: List[str]) -> List[str]:
+    """Vectorized is_productish over a whole list (same rules, one pass per regex)."""
+    if not terms:
+        return []
+    # python storage keeps re semantics (pyarrow would hand the patterns to RE2)
+    s = pd.Series(terms, dtype="string[python]").str.strip()
+    short = s.str.len() <= 20
+    mask = (s.str.len() > 1) & (
+        s.str.contains(_MODEL_TOKEN, na=False)
+        | s.str.contains(_KATAKANA, na=False)
+        | s.str.contains(_RE_HINTS, na=False)
+        | (s.str.contains(_RE_ASCII, na=False) & short)
+    )
+    return [t for t, keep in zip(terms, mask.fillna(False)) if keep]
+
+@functools.lru_cache(maxsize=1024)
 def sanitize_keyword(s: str) -> str:
-    s = re.sub(r"[\u3000\s]+", " ", s)
-    s = re.sub(r"[^\w\u3040-\u309F\u30A0-\u30FF\u4E00-\u9FFF\-\+A-Za-z0-9 ]", " ", s)
-    s = re.sub(r"\s{2,}", " ", s).strip()
+    s = _RE_WS.sub(" ", s)
+    s = _RE_NONWORD.sub(" ", s)
+    s = _RE_MULTISPACE.sub(" ", s).strip()
     return s[:120]
 
-def rakuten_search_first_affiliate_url(keyword: str) -> str:
+def rate_limit_wait_seconds(headers, attempt: int) -> float:
+    """Seconds to wait after a 429: Retry-After / X-RateLimit-Reset if present,
+    otherwise exponential backoff with jitter."""
+    headers = headers or {}
+    ra = headers.get("Retry-After")
+    if ra:
+        try:
+            return min(60.0, max(0.0, float(ra)))
+        except ValueError:
+            try:
+                when = parsedate_to_datetime(ra)
+                if when.tzinfo is None:
+                    when = when.replace(tzinfo=dt.timezone.utc)
+                delta = (when - dt.datetime.now(dt.timezone.utc)).total_seconds()
+                return min(60.0, max(0.0, delta))
+            except (TypeError, ValueError):
+                pass
+    reset = headers.get("X-RateLimit-Reset")
+    if reset:
+        try:
+            value = float(reset)
+            # epoch秒 と「残り秒数」の両方の流儀がある
+            if value > 1e9:
+                value -= time.time()
+            return min(60.0, max(0.0, value))
+        except ValueError:
+            pass
+    return min(60, 2 ** attempt) + random.uniform(0, 0.5)
+
+def _make_throttle(interval: float):
+    """Return an awaitable gate that spaces request starts `interval` seconds apart."""
+    lock = asyncio.Lock()
+    next_at = 0.0
+    async def throttle():
+        nonlocal next_at
+        async with lock:
+            now = asyncio.get_running_loop().time()
+            delay = next_at - now
+            next_at = max(now, next_at) + interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+    return throttle
+
+async def rakuten_search_first_affiliate_url_async(session: aiohttp.ClientSession,
+                                                   sem: asyncio.Semaphore,
+                                                   keyword: str,
+                                                   throttle=None) -> Optional[str]:
+    """Return the first item's URL, None if Rakuten has no items, "" on errors."""
     if not RAKUTEN_APP_ID or not RAKUTEN_AFFILIATE_ID:
         logger.warning("Rakuten IDs not set; skipping Rakuten URL.")
         return ""
     endpoint = "https://app.rakuten.co.jp/services/api/IchibaItem/Search/20220601"
     kw = sanitize_keyword(keyword)
-    for attempt in range(5):
-        params = {"applicationId": RAKUTEN_APP_ID, "affiliateId": RAKUTEN_AFFILIATE_ID,
-                  "format": "json", "keyword": kw, "hits": 1, "sort": "-reviewCount"}
-        try:
-            resp = requests.get(endpoint, params=params, timeout=10)
-            resp.raise_for_status()
-            data = resp.json()
-            items = data.get("Items", [])
-            if not items:
-                logger.info(f"Rakuten: no items for '{kw}'")
+    waited = 0.0
+    async with sem:
+        for attempt in range(5):
+            params = {"applicationId": RAKUTEN_APP_ID, "affiliateId": RAKUTEN_AFFILIATE_ID,
+                      "format": "json", "keyword": kw, "hits": 1, "sort": "-reviewCount"}
+            try:
+                if throttle:
+                    await throttle()
+                async with session.get(endpoint, params=params) as resp:
+                    resp.raise_for_status()
+                    data = await resp.json(content_type=None)
+                items = data.get("Items", [])
+                if not items:
+                    logger.info("Rakuten: no items for '%s'", kw)
+                    return None
+                item = items[0].get("Item", {})
+                return item.get("affiliateUrl") or item.get("itemUrl", "")
+            except aiohttp.ClientResponseError as e:
+                status = e.status
+                if status == 429:
+                    if attempt == 4:
+                        break  # no attempt left; don't sleep for nothing
+                    wait = rate_limit_wait_seconds(e.headers, attempt)
+                    waited += wait
+                    await asyncio.sleep(wait); continue
+                if status == 400 and len(kw) > 40:
+                    kw = " ".join(kw.split()[:6])
+                    logger.warning("Rakuten 400; shorten keyword and retry: '%s'", kw)
+                    continue
+                logger.error("Rakuten API HTTPError (%s) for '%s': %s", status, kw, e)
                 return ""
-            item = items[0].get("Item", {})
-            return item.get("affiliateUrl") or item.get("itemUrl", "")
-        except requests.HTTPError as e:
-            status = getattr(e.response, "status_code", None)
-            if status == 429:
-                wait = 1.2 * (attempt + 1)
-                logger.warning(f"Rakuten 429; retrying in {wait:.1f}s (attempt {attempt+1}/5)")
-                time.sleep(wait); continue
-            if status == 400 and len(kw) > 40:
-                kw = " ".join(kw.split()[:6])
-                logger.warning(f"Rakuten 400; shorten keyword and retry: '{kw}'")
-                continue
-            logger.error(f"Rakuten API HTTPError ({status}) for '{kw}': {e}")
-            return ""
-        except Exception as e:
-            logger.error(f"Rakuten API error for '{kw}': {e}")
-            return ""
-    return ""
+            except Exception as e:
+                logger.error("Rakuten API error for '%s': %s", kw, e)
+                return ""
+        logger.warning("Rakuten: giving up on '%s' after 5 attempts (%.1fs rate-limit wait)", kw, waited)
+        return ""
+
+async def _rakuten_urls_async(keywords: List[str]) -> List[str]:
+    sem = asyncio.Semaphore(RAKUTEN_CONCURRENCY)
+    throttle = _make_throttle(RAKUTEN_MIN_INTERVAL_SEC)
+    connector = aiohttp.TCPConnector(limit=8, keepalive_timeout=30)
+    timeout = aiohttp.ClientTimeout(total=10)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        return await asyncio.gather(
+            *[rakuten_search_first_affiliate_url_async(session, sem, kw, throttle) for kw in keywords])
+
+def _open_rakuten_cache(day: str):
+    """Open the on-disk URL cache, dropping entries from previous days."""
+    try:
+        db = shelve.open(str(RAKUTEN_CACHE_DB))
+    except Exception as e:
+        logger.warning(f"Rakuten cache unavailable; continuing without it. Reason: {e}")
+        return None
+    for k in [k for k in db.keys() if not k.startswith(day + "|")]:
+        del db[k]
+    return db
+
+def rakuten_search_first_affiliate_urls(keywords: List[str], ts: dt.datetime) -> List[str]:
+    """Look up Rakuten URLs for all keywords concurrently (one shared session).
+
+    Hits and no-item results are cached per day on the sanitized keyword,
+    in memory and in RAKUTEN_CACHE_DB (stored as ""), so repeated terms skip
+    the API (and its pacing).
+    """
+    if not keywords:
+        return []
+    day = ts.strftime("%Y-%m-%d")
+    keys = [f"{day}|{sanitize_keyword(kw)}" for kw in keywords]
+    db = _open_rakuten_cache(day)
+    try:
+        if db is not None:
+            for key in keys:
+                if key in _RAKUTEN_MEMO or key in _NEG_CACHE or key not in db:
+                    continue
+                url = db[key]
+                if url:
+                    _RAKUTEN_MEMO[key] = url
+                else:
+                    _NEG_CACHE.add(key)
+        pending = {}
+        for kw, key in zip(keywords, keys):
+            if key not in _RAKUTEN_MEMO and key not in _NEG_CACHE:
+                pending.setdefault(key, kw)
+        logger.info("Rakuten cache: %d hit(s), %d lookup(s)", len(keys) - len(pending), len(pending))
+        if pending:
+            fetched = asyncio.run(_rakuten_urls_async(list(pending.values())))
+            for key, url in zip(pending, fetched):
+                if url is None:
+                    _NEG_CACHE.add(key)
+                    url = ""
+                elif url:
+                    _RAKUTEN_MEMO[key] = url
+                else:
+                    continue  # errors are retried next run
+                if db is not None:
+                    db[key] = url
+    finally:
+        if db is not None:
+            db.close()
+    return [_RAKUTEN_MEMO.get(key, "") for key in keys]
+
+_AMZ_BASE = "https://www.amazon.co.jp/s?k="
+_AMZ_TAIL = f"&tag={quote_plus(AMAZON_ASSOCIATE_TAG)}" if AMAZON_ASSOCIATE_TAG else ""
 
 def amazon_search_url(keyword: str) -> str:
-    base = "https://www.amazon.co.jp/s"
-    q = {"k": keyword}
-    if AMAZON_ASSOCIATE_TAG: q["tag"] = AMAZON_ASSOCIATE_TAG
-    return f"{base}?{urlencode(q, quote_via=quote_plus)}"
+    return _AMZ_BASE + quote_plus(keyword, safe="") + _AMZ_TAIL
+
+def _iso_date(value):
+    """Date cells from the old pandas-written sheet -> "YYYY-MM-DD" text."""
+    if isinstance(value, dt.date):
+        return value.strftime("%Y-%m-%d")
+    return value
+
+def _row_key(date, keyword) -> str:
+    return f"{_iso_date(date)}|{keyword}"
+
+def _new_sheet():
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("Sheet1")  # pandas' to_excel default; keep existing references working
+    ws.append(EXCEL_COLUMNS)
+    return wb, ws
 
 def append_to_excel(rows):
-    df_new = pd.DataFrame(rows, columns=["timestamp", "date", "keyword", "rakuten_url", "amazon_url"])
+    """Stream existing rows + new (date, keyword) rows into a write-only workbook."""
+    wb, ws = _new_sheet()
+    seen, total = set(), 0
     if OUTPUT_XLSX.exists():
         try:
-            df_old = pd.read_excel(OUTPUT_XLSX)
-            df_all = pd.concat([df_old, df_new], ignore_index=True)
+            src = openpyxl.load_workbook(OUTPUT_XLSX, read_only=True, data_only=True, keep_links=False)
+            try:
+                for row in src.active.iter_rows(min_row=2, values_only=True):
+                    if not any(v is not None for v in row):
+                        continue
+                    row = list(row)
+                    row[1] = _iso_date(row[1])
+                    ws.append(row)
+                    seen.add(_row_key(row[1], row[2]))
+                    total += 1
+            finally:
+                src.close()
         except Exception as e:
             logger.warning(f"Failed to read existing Excel, recreating. Reason: {e}")
-            df_all = df_new
-    else:
-        df_all = df_new
-    if not df_all.empty:
-        df_all["date"] = pd.to_datetime(df_all["date"]).dt.date
-        df_all = df_all.drop_duplicates(subset=["date", "keyword"], keep="first")
-    with pd.ExcelWriter(OUTPUT_XLSX, engine="openpyxl", mode="w") as writer:
-        df_all.to_excel(writer, index=False)
-    logger.info(f"Excel updated: {OUTPUT_XLSX} ({len(df_all)} rows total)")
+            ws.close()  # discard the partial copy
+            wb, ws = _new_sheet()
+            seen, total = set(), 0
+    added = 0
+    for r in rows:
+        key = _row_key(r["date"], r["keyword"])
+        if key in seen:
+            continue
+        seen.add(key)
+        ws.append([r.get(c, "") for c in EXCEL_COLUMNS])
+        added += 1
+    tmp_path = OUTPUT_XLSX.with_name(OUTPUT_XLSX.name + ".tmp")
+    wb.save(tmp_path)
+    os.replace(tmp_path, OUTPUT_XLSX)
+    logger.info(f"Excel updated: {OUTPUT_XLSX} (+{added} rows, {total + added} rows total)")
 
 # ===== Email bodies & attachments =====
 def link_label(url: str) -> str:
@@ -199,65 +413,90 @@ def link_label(url: str) -> str:
     if "amazon.co.jp" in u: return "Amazonで見る"
     return "商品を見る"
 
+_CTA_TPL = ("<!-- {kw} -->\n"
+            "<div style=\"margin:16px 0;\">\n"
+            "  <a href=\"{url}\" rel=\"nofollow sponsored\" "
+            "style=\"display:inline-block;padding:12px 16px;background:#2563eb;color:#fff;border-radius:8px;text-decoration:none;font-weight:700;\">{label}</a>\n"
+            "</div>")
+
 def build_copy_snippets(rows: List[dict]) -> str:
-    """Return raw HTML CTA snippets (unescaped) for Hatena HTML editor."""
-    parts = []
-    for r in rows:
-        kw = str(r.get("keyword","")).strip()
-        url = r.get("rakuten_url") or r.get("amazon_url") or ""
-        if not url: continue
-        label = link_label(url)
-        parts.append(f"<!-- {kw} -->\n"
-                     f"<div style=\"margin:16px 0;\">\n"
-                     f"  <a href=\"{url}\" rel=\"nofollow sponsored\" "
-                     f"style=\"display:inline-block;padding:12px 16px;background:#2563eb;color:#fff;border-radius:8px;text-decoration:none;font-weight:700;\">{label}</a>\n"
-                     f"</div>\n")
-    return "\n".join(parts).strip()
-
-def build_email_bodies(rows: List[dict], ts: dt.datetime) -> (str, str):
-    """Return (plain_text, html) bodies; html includes table + notice about attachments."""
+    """Return raw HTML CTA snippets for Hatena HTML editor (keyword/URL escaped)."""
+    return "\n\n".join(
+        _CTA_TPL.format(kw=htmlmod.escape(str(r.get("keyword","")).strip()),
+                        url=htmlmod.escape(url, quote=True), label=link_label(url))
+        for r in rows if (url := r.get("rakuten_url") or r.get("amazon_url") or ""))
+
+_NO_TRENDS_MSG = "自動送信: トレンドが取得できませんでした。空のシートを添付します。"
+_HTML_ROW_TPL = "<tr><td>{kw}</td><td>{rlink}</td><td>{alink}</td></tr>"
+_HTML_NOTE = ("<p style='color:#555;font-size:12px'>※ はてな<strong>HTMLエディタ</strong>に貼る用のCTAコードを "
+              "<strong>hatena_cta_snippets.txt</strong> と <strong>.html</strong> で添付しています。"
+              "iPhoneなら添付を開いて全選択→コピーで貼り付け可能です。</p>")
+
+def build_text_body(rows: List[dict], ts: dt.datetime) -> str:
+    """Return the plain-text body."""
     timestamp = ts.strftime("%Y-%m-%d %H:%M JST")
     if not rows:
-        plain = f"自動送信: トレンドが取得できませんでした。空のシートを添付します。\n生成時刻: {timestamp}\n"
-        html = f"""<p>自動送信: トレンドが取得できませんでした。空のシートを添付します。<br>生成時刻: {htmlmod.escape(timestamp)}</p>"""
-        return plain, html
-
-    # Plain text
-    lines = [f"自動送信: 本日のトレンド商品一覧（{timestamp}）", f"件数: {len(rows)}", ""]
+        return f"{_NO_TRENDS_MSG}\n生成時刻: {timestamp}\n"
+    buf = io.StringIO()
+    buf.write(f"自動送信: 本日のトレンド商品一覧（{timestamp}）\n件数: {len(rows)}\n")
     for r in rows:
-        kw = r.get("keyword","")
-        lines.append(f"- {kw}")
+        buf.write(f"\n- {r.get('keyword','')}")
         if r.get("rakuten_url"):
-            lines.append(f"   楽天: {r['rakuten_url']}")
+            buf.write(f"\n   楽天: {r['rakuten_url']}")
         if r.get("amazon_url"):
-            lines.append(f"   Amazon: {r['amazon_url']}")
-    plain = "\n".join(lines)
+            buf.write(f"\n   Amazon: {r['amazon_url']}")
+    return buf.getvalue()
 
-    # HTML
-    rows_html = []
-    for r in rows:
-        kw = htmlmod.escape(str(r.get("keyword","")))
-        rurl = r.get("rakuten_url") or ""
-        aurl = r.get("amazon_url") or ""
-        rlink = f'<a href="{htmlmod.escape(rurl)}">楽天</a>' if rurl else ""
-        alink = f'<a href="{htmlmod.escape(aurl)}">Amazon</a>' if aurl else ""
-        rows_html.append(f"<tr><td>{kw}</td><td>{rlink}</td><td>{alink}</td></tr>")
-    table = "\n".join(rows_html)
-    note = ("<p style='color:#555;font-size:12px'>※ はてな<strong>HTMLエディタ</strong>に貼る用のCTAコードを "
-            "<strong>hatena_cta_snippets.txt</strong> と <strong>.html</strong> で添付しています。"
-            "iPhoneなら添付を開いて全選択→コピーで貼り付け可能です。</p>")
-    html = f"""
+def build_html_body(rows: List[dict], ts: dt.datetime) -> str:
+    """Return the HTML body: table + notice about attachments."""
+    timestamp = htmlmod.escape(ts.strftime("%Y-%m-%d %H:%M JST"))
+    if not rows:
+        return f"<p>{_NO_TRENDS_MSG}<br>生成時刻: {timestamp}</p>"
+    buf = io.StringIO()
+    buf.write(f"""
     <div>
-      <p>自動送信: 本日のトレンド商品一覧（{htmlmod.escape(timestamp)}）</p>
+      <p>自動送信: 本日のトレンド商品一覧（{timestamp}）</p>
       <p>件数: {len(rows)}</p>
       <table border="1" cellpadding="6" cellspacing="0" style="border-collapse:collapse">
         <thead><tr><th>キーワード</th><th>楽天</th><th>Amazon</th></tr></thead>
-        <tbody>{table}</tbody>
+        <tbody>""")
+    for i, r in enumerate(rows):
+        rurl = r.get("rakuten_url") or ""
+        aurl = r.get("amazon_url") or ""
+        if i:
+            buf.write("\n")
+        buf.write(_HTML_ROW_TPL.format_map({
+            "kw": htmlmod.escape(str(r.get("keyword",""))),
+            "rlink": f'<a href="{htmlmod.escape(rurl)}">楽天</a>' if rurl else "",
+            "alink": f'<a href="{htmlmod.escape(aurl)}">Amazon</a>' if aurl else "",
+        }))
+    buf.write(f"""</tbody>
       </table>
-      {note}
+      {_HTML_NOTE}
     </div>
-    """
-    return plain, html
+    """)
+    return buf.getvalue()
+
+def _attach_file(msg: EmailMessage, path: pathlib.Path, maintype: str, subtype: str,
+                 charset: Optional[str] = None) -> None:
+    """Attach a file base64-encoded in one C-level pass over an mmap of it."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            encoded = ""
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                # 76文字折り返し（RFC 2045）はencodebytesがCで済ませる
+                encoded = base64.encodebytes(mm).decode("ascii")
+    part = EmailMessage(policy=msg.policy)
+    part["Content-Type"] = f"{maintype}/{subtype}"
+    if charset:
+        part.set_param("charset", charset)
+    part["Content-Transfer-Encoding"] = "base64"
+    part.add_header("Content-Disposition", "attachment", filename=path.name)
+    part.set_payload(encoded)
+    if msg.get_content_type() != "multipart/mixed":
+        msg.make_mixed()
+    msg.attach(part)
 
 def send_email_with_attachments(
     smtp_host: str,
@@ -287,23 +526,18 @@ def send_email_with_attachments(
         msg.add_alternative(body_html, subtype="html")
 
     # Attach Excel
-    with open(attachment_main_xlsx, "rb") as f:
-        data = f.read()
-    msg.add_attachment(data, maintype="application",
-                       subtype="vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                       filename=attachment_main_xlsx.name)
+    _attach_file(msg, attachment_main_xlsx, "application",
+                 "vnd.openxmlformats-officedocument.spreadsheetml.sheet")
 
     # Extra attachments
     for p in (extra_attachments or []):
-        with open(p, "rb") as f:
-            data = f.read()
         # Guess simple subtype
         if p.suffix.lower() == ".txt":
-            msg.add_attachment(data, maintype="text", subtype="plain", filename=p.name)
+            _attach_file(msg, p, "text", "plain", charset="utf-8")
         elif p.suffix.lower() in (".htm", ".html"):
-            msg.add_attachment(data, maintype="text", subtype="html", filename=p.name)
+            _attach_file(msg, p, "text", "html", charset="utf-8")
         else:
-            msg.add_attachment(data, maintype="application", subtype="octet-stream", filename=p.name)
+            _attach_file(msg, p, "application", "octet-stream")
 
     # Send
     with smtplib.SMTP(smtp_host, smtp_port, timeout=30) as server:
@@ -332,7 +566,8 @@ def main(top_n=20):
             if email_enabled():
                 subj = (EMAIL_CFG.get("SUBJECT", "トレンド商品レポート（{date} {time}）")
                         .format(date=ts.strftime("%Y-%m-%d"), time=ts.strftime("%H:%M")))
-                plain, html = build_email_bodies([], ts)
+                plain = build_text_body([], ts)
+                html = build_html_body([], ts) if EMAIL_CFG.get("HTML", True) else None
                 send_email_with_attachments(
                     EMAIL_CFG["SMTP_HOST"], int(EMAIL_CFG["SMTP_PORT"]),
                     EMAIL_CFG["SMTP_USER"], EMAIL_CFG["SMTP_PASSWORD"],
@@ -340,12 +575,12 @@ def main(top_n=20):
                 )
             return 1
 
-    product_terms = trends if NO_FILTER else [t for t in trends if is_productish(t)]
+    product_terms = trends if NO_FILTER else filter_productish(trends)
     logger.info("Product-like=%s", product_terms)
 
     rows = []
-    for term in product_terms:
-        r_url = rakuten_search_first_affiliate_url(term)
+    r_urls = rakuten_search_first_affiliate_urls(product_terms, ts)
+    for term, r_url in zip(product_terms, r_urls):
         a_url = amazon_search_url(term)
         rows.append({
             "timestamp": ts.strftime("%Y-%m-%d %H:%M:%S%z"),
@@ -354,7 +589,6 @@ def main(top_n=20):
             "rakuten_url": r_url,
             "amazon_url": a_url
         })
-        time.sleep(0.8)
 
     append_to_excel(rows)
 
@@ -364,17 +598,21 @@ def main(top_n=20):
     if snippets:
         txt_path = APP_DIR / "hatena_cta_snippets.txt"
         html_path = APP_DIR / "hatena_cta_snippets.html"
-        txt_path.write_text(snippets, encoding="utf-8")
         # Simple HTML wrapper so iPhoneで開いてコピーしやすい
         html_wrapper = f"<!doctype html><meta charset='utf-8'><pre>{htmlmod.escape(snippets)}</pre>"
-        html_path.write_text(html_wrapper, encoding="utf-8")
+        with ThreadPoolExecutor(max_workers=2) as ex:
+            writes = [ex.submit(txt_path.write_text, snippets, encoding="utf-8"),
+                      ex.submit(html_path.write_text, html_wrapper, encoding="utf-8")]
+        for w in writes:
+            w.result()
         extra_paths.extend([txt_path, html_path])
 
     if email_enabled():
         count = len(rows)
         subj = (EMAIL_CFG.get("SUBJECT", "トレンド商品レポート（{date} {time}）")
                 .format(date=ts.strftime("%Y-%m-%d"), time=ts.strftime("%H:%M")))
-        plain, html = build_email_bodies(rows, ts)
+        plain = build_text_body(rows, ts)
+        html = build_html_body(rows, ts) if EMAIL_CFG.get("HTML", True) else None
         send_email_with_attachments(
             EMAIL_CFG["SMTP_HOST"], int(EMAIL_CFG["SMTP_PORT"]),
             EMAIL_CFG["SMTP_USER"], EMAIL_CFG["SMTP_PASSWORD"],